@@ -2,17 +2,28 @@
 
 # imports
 import sqlalchemy
+import psycopg2.extras
 import os
+import collections
+import functools
+import multiprocessing
+import shutil
+import subprocess
 import datetime
+import re
 import zipfile
 import io
-import json
+import orjson
 
 ################################################################################
 # helper functions
 ################################################################################
 
 
+# str.translate deletes every character mapped to None in a single pass
+_null_translation = str.maketrans('', '', '\x00')
+
+
 def remove_nulls(s):
     r'''
     Postgres doesn't support strings with the null character \x00 in them, but twitter does.
@@ -31,51 +42,401 @@ def remove_nulls(s):
     ''
     >>> remove_nulls('hello\x00 world')
     'hello world'
+    >>> remove_nulls(None) is None
+    True
+    '''
+    # nearly every string has no null characters, and the membership test avoids copying those strings
+    if s and '\x00' in s:
+        return s.translate(_null_translation)
+    return s
+
+
+# maps place ids to the WKT string of the place's bounding box;
+# the least recently used places are evicted once the cache holds _place_geo_cache_size entries
+_place_geo_cache = collections.OrderedDict()
+_place_geo_cache_size = 200000
+
+
+def build_geo(tweet):
     '''
-    if s is None:
+    Return the WKT string for the location of a tweet.
+
+    Tweets with exact coordinates are stored as a POINT;
+    otherwise, the bounding box of the tweet's place is stored as a POLYGON.
+    Tweets with neither return None.
+
+    >>> build_geo({'geo': {'coordinates': [40.5, -74.25]}})
+    'POINT(40.5 -74.25)'
+    >>> build_geo({'geo': None, 'place': {'id': 'abc', 'bounding_box': {'coordinates': [[[0, 0], [0, 1], [1, 1]]]}}})
+    'POLYGON((0 0,0 1,1 1,0 0))'
+    >>> build_geo({'geo': None, 'place': None}) is None
+    True
+    '''
+    geo = tweet.get('geo')
+    if geo is not None:
+        c = geo['coordinates']
+        return f'POINT({c[0]} {c[1]})'
+
+    try:
+        place = tweet['place']
+        coords = place['bounding_box']['coordinates']
+    except (KeyError, TypeError):
         return None
-    else:
-        return s.replace('\x00','')
+
+    # a place's bounding box never changes, and most tweets come from a small number of places,
+    # so the polygon string is only built once per place
+    place_id = place.get('id')
+    if place_id in _place_geo_cache:
+        _place_geo_cache.move_to_end(place_id)
+        return _place_geo_cache[place_id]
+
+    # each polygon is closed by repeating its first point
+    geo = 'POLYGON(' + ','.join(
+        '(' + ','.join(f'{x} {y}' for x,y in poly) + f',{poly[0][0]} {poly[0][1]})'
+        for poly in coords
+        ) + ')'
+    if place_id is not None:
+        _place_geo_cache[place_id] = geo
+        while len(_place_geo_cache)>_place_geo_cache_size:
+            _place_geo_cache.popitem(last=False)
+    return geo
+
+
+# maps urls to their id_urls in the urls table;
+# urls (especially t.co links and media hosts) repeat heavily between tweets,
+# so caching them avoids most of the round-trips to the urls table;
+# the least recently used urls are evicted once the cache holds url_id_cache_size entries
+url_id_cache = collections.OrderedDict()
+url_id_cache_size = 200000
+
+
+def get_id_urls_many(urls, connection):
+    '''
+    Given a collection of urls, return a dict mapping each url to the corresponding id in the urls table.
+    If no row exists for a url, then one is inserted automatically.
+    All of the urls missing from url_id_cache are resolved with a single statement.
+
+    NOTE:
+    This function cannot be tested with standard python testing tools because it interacts with the db.
+    '''
+    id_urls = {}
+    missing = []
+    for url in set(urls):
+        if url in url_id_cache:
+            url_id_cache.move_to_end(url)
+            id_urls[url] = url_id_cache[url]
+        else:
+            missing.append(url)
+    # several loaders may run concurrently;
+    # inserting rows in a consistent order prevents them from deadlocking each other
+    #
+    # NOTE:
+    # some tweets have "expanded_url": null;
+    # like the original one-url-at-a-time version of this function, a null url gets its own row in the urls table
+    # (a null never conflicts with the unique constraint), so the sort key must also order None
+    missing.sort(key=lambda url: (url is None, url or ''))
+
+    if missing:
+        # "do update" is used instead of "do nothing" so that the query also returns
+        # the id_urls of the urls that are already in the table
+        cursor = connection.connection.cursor()
+        res = psycopg2.extras.execute_values(cursor, '''
+        insert into urls
+            (url)
+            values %s
+        on conflict (url) do update set url=excluded.url
+        returning url, id_urls
+        ;
+        ''', [ (url,) for url in missing ], page_size=500, fetch=True)
+
+        for url,id_url in res:
+            id_urls[url] = id_url
+            url_id_cache[url] = id_url
+        while len(url_id_cache)>url_id_cache_size:
+            url_id_cache.popitem(last=False)
+
+    return id_urls
+
+
+# the ids of every user inserted into the users table during this run;
+# popular accounts are mentioned millions of times,
+# and there is no need to send their unhydrated rows to the db more than once
+seen_user_ids = set()
+
+
+def copy_value(value):
+    r'''
+    Format a python value as a field of postgres' COPY text format.
+
+    NULLs are written as \N, and the characters that COPY treats specially
+    (backslash, tab, newline, carriage return) are escaped.
+    Python lists are converted into postgres array literals.
+
+    >>> copy_value(None)
+    '\\N'
+    >>> copy_value(True)
+    't'
+    >>> copy_value('hello\tworld\n')
+    'hello\\tworld\\n'
+    >>> copy_value(['US','DE'])
+    '{"US","DE"}'
+    '''
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, list):
+        value = '{' + ','.join('"' + str(v).replace('\\','\\\\').replace('"','\\"') + '"' for v in value) + '}'
+    return str(value).replace('\\','\\\\').replace('\t','\\t').replace('\n','\\n').replace('\r','\\r')
 
 
-def get_id_urls(url, connection):
+def copy_rows(cursor, sql, rows):
     '''
-    Given a url, return the corresponding id in the urls table.
-    If no row exists for the url, then one is inserted automatically.
+    Load a list of row tuples using sql, a COPY ... FROM STDIN command.
 
     NOTE:
     This function cannot be tested with standard python testing tools because it interacts with the db.
     '''
-    sql = sqlalchemy.sql.text('''
-    insert into urls 
-        (url)
-        values
-        (:url)
-    on conflict do nothing
-    returning id_urls
-    ;
-    ''')
-    res = connection.execute(sql,{'url':url}).first()
-
-    # when no conflict occurs, then the query above inserts a new row in the url table and returns id_urls in res[0];
-    # when a conflict occurs, then the query above does not insert or return anything;
-    # we need to run a select statement to put the already existing id_urls into res[0]
-    if res is None:
-        sql = sqlalchemy.sql.text('''
-        select id_urls 
-        from urls
+    buf = io.StringIO()
+    for row in rows:
+        buf.write('\t'.join(copy_value(value) for value in row))
+        buf.write('\n')
+    buf.seek(0)
+    cursor.copy_expert(sql, buf)
+
+
+# the USPS codes of the US states, DC, and the territories;
+# place names like "Los Angeles, CA" end in one of these codes,
+# but others (e.g. "California, USA") do not
+_us_state_codes = frozenset([
+    'al', 'ak', 'az', 'ar', 'ca', 'co', 'ct', 'de', 'fl', 'ga',
+    'hi', 'id', 'il', 'in', 'ia', 'ks', 'ky', 'la', 'me', 'md',
+    'ma', 'mi', 'mn', 'ms', 'mo', 'mt', 'ne', 'nv', 'nh', 'nj',
+    'nm', 'ny', 'nc', 'nd', 'oh', 'ok', 'or', 'pa', 'ri', 'sc',
+    'sd', 'tn', 'tx', 'ut', 'vt', 'va', 'wa', 'wv', 'wi', 'wy',
+    'dc', 'as', 'gu', 'mp', 'pr', 'vi',
+    ])
+
+
+# the columns that flush_batch loads into each table
+table_columns = {
+    'users': ['id_users', 'created_at', 'updated_at', 'id_urls', 'friends_count',
+        'listed_count', 'favourites_count', 'statuses_count', 'protected', 'verified',
+        'screen_name', 'name', 'location', 'description', 'withheld_in_countries'],
+    'tweets': ['id_tweets', 'id_users', 'created_at', 'in_reply_to_status_id',
+        'in_reply_to_user_id', 'quoted_status_id',
+        'retweet_count', 'favorite_count',
+        'quote_count', 'withheld_copyright',
+        'withheld_in_countries', 'source', 'text',
+        'country_code', 'state_code',
+        'lang', 'place_name', 'geo'],
+    'tweet_urls': ['id_tweets', 'id_urls'],
+    'tweet_mentions': ['id_tweets', 'id_users'],
+    'tweet_tags': ['id_tweets', 'tag'],
+    'tweet_media': ['id_tweets', 'id_urls', 'type'],
+    }
+
+
+# the statements that flush_tables runs for every batch are built once, when the module is imported
+sql_copy_stage = {
+    table: f'copy stage_{table} ({", ".join(columns)}) from stdin'
+    for table,columns in table_columns.items()
+    }
+sql_execute_stage = {
+    table: f'execute insert_stage_{table};'
+    for table in table_columns
+    }
+
+
+def prepare_statements(connection):
+    '''
+    Create the staging tables and the prepared statements used by flush_batch.
+    This must be called once on every new connection before flush_batch.
+
+    flush_batch loads each table's rows into a staging table with COPY,
+    and then moves them into the real table with a single prepared insert ... select.
+    The staging tables are temporary, so they are not written to the WAL,
+    every connection (i.e. every worker) gets its own copy,
+    and their rows are deleted automatically when each batch's transaction finishes.
+    Preparing the statements means that postgres parses them once per connection instead of once per batch.
+
+    NOTE:
+    This function cannot be tested with standard python testing tools because it interacts with the db.
+    '''
+    with connection.begin() as trans:
+        cursor = connection.connection.cursor()
+        for table in table_columns:
+            cursor.execute(f'''
+            create temporary table stage_{table}
+                (like {table} including defaults)
+                on commit delete rows
+            ;
+            ''')
+
+        # both the hydrated and the unhydrated users are inserted by this single statement;
+        # a hydrated row updates the existing row, but an unhydrated row never does,
+        # so that it cannot shadow a hydrated row;
+        # unhydrated rows are recognized by their null created_at, which every hydrated user has;
+        # the update is also skipped when nothing changed to avoid creating dead tuples
+        #
+        # the users that are only known from a reply (see the NOTE in flush_batch) are derived here from stage_tweets
+        # and stored unhydrated, with every column except id_users null;
+        # users that are already staged by the batch or already in the db are skipped
+        #
+        # NOTE:
+        # "on conflict" waits for other transactions that inserted the same users;
+        # inserting all of the batch's users in one statement in id order means that
+        # concurrent loaders wait for the users' row locks in the same order,
+        # which avoids most deadlocks between them (insert_batch retries the remaining ones)
+        columns = table_columns['users']
+        updated_columns = columns[1:]
+        cursor.execute(f'''
+        prepare insert_stage_users as
+        insert into users
+            ({', '.join(columns)})
+            select {', '.join(columns)}
+            from (
+                select {', '.join(columns)}
+                from stage_users
+                union all
+                select id_users, {', '.join('null' for column in updated_columns)}
+                from (
+                    select distinct in_reply_to_user_id as id_users
+                    from stage_tweets
+                    where in_reply_to_user_id is not null
+                ) as reply_users
+                where
+                    id_users not in (select id_users from stage_users) and
+                    not exists (select 1 from users where users.id_users = reply_users.id_users)
+            ) as batch_users
+            order by id_users
+        on conflict (id_users) do update set
+            ({', '.join(updated_columns)})
+            = ({', '.join('excluded.'+column for column in updated_columns)})
         where
-            url=:url
+            excluded.created_at is not null and
+            ({', '.join('users.'+column for column in updated_columns)})
+            is distinct from ({', '.join('excluded.'+column for column in updated_columns)})
+        ;
         ''')
-        res = connection.execute(sql,{'url':url}).first()
 
-    id_urls = res[0]
-    return id_urls
+        for table in ['tweets', 'tweet_urls', 'tweet_mentions', 'tweet_tags', 'tweet_media']:
+            columns = table_columns[table]
+            cursor.execute(f'''
+            prepare insert_stage_{table} as
+            insert into {table}
+                ({', '.join(columns)})
+                select {', '.join(columns)}
+                from stage_{table}
+            on conflict do nothing
+            ;
+            ''')
+
+
+def flush_tables(cursor, tables_rows):
+    '''
+    COPY each table's rows into its staging table, and then move them all into the real tables.
+
+    Each COPY needs its own round-trip to the db,
+    but the inserts from the staging tables are sent together as a single multi-statement query,
+    so they cost one round-trip in total instead of one per table.
+    Postgres runs the inserts in the order of tables_rows, which must respect the foreign keys.
+    Every COPY finishes before the first insert runs,
+    so an insert may also read the staging tables of later tables
+    (the users insert reads stage_tweets to find the users that are only known from a reply).
+
+    Args:
+        cursor: a psycopg2 cursor
+        tables_rows: a dict mapping the keys of table_columns to lists of row tuples
+
+    NOTE:
+    This function cannot be tested with standard python testing tools because it interacts with the db.
+    '''
+    tables = [ table for table,rows in tables_rows.items() if rows ]
+    for table in tables:
+        copy_rows(cursor, sql_copy_stage[table], tables_rows[table])
+    if tables:
+        cursor.execute('\n'.join(sql_execute_stage[table] for table in tables))
+
+
+def db_error(e):
+    '''
+    Return the psycopg2 error behind e.
+    Errors raised by the raw cursor are psycopg2 errors already,
+    but errors raised through sqlalchemy (e.g. by the commit) are wrapped in a sqlalchemy.exc.DBAPIError.
+    '''
+    return getattr(e, 'orig', e)
+
+
+def rollback_caches():
+    '''
+    Forget the cached urls and users after a rollback;
+    the rolled back transaction may have inserted rows that are cached but no longer exist in the db.
+    '''
+    url_id_cache.clear()
+    seen_user_ids.clear()
+
+
+def flush_transaction(connection,tweets,max_attempts=5):
+    '''
+    Insert the tweets within a single transaction.
+
+    Concurrent loaders can deadlock on each other or fail to serialize;
+    postgres rolls back one of the transactions, which then succeeds when it is simply run again.
+    The transaction is retried up to max_attempts times; every other error is raised.
+
+    NOTE:
+    This function cannot be tested with standard python testing tools because it interacts with the db.
+    '''
+    for attempt in range(1,max_attempts+1):
+        try:
+            with connection.begin() as trans:
+                flush_batch(connection,tweets)
+            return
+        except (psycopg2.Error, sqlalchemy.exc.DBAPIError) as e:
+            rollback_caches()
+            if attempt==max_attempts or not isinstance(db_error(e), psycopg2.extensions.TransactionRollbackError):
+                raise
+            print(datetime.datetime.now(),'transaction rolled back, retrying:',db_error(e))
+
+
+def insert_batch(connection,tweets):
+    '''
+    Insert a batch of tweets into the database within a single transaction.
+
+    Committing once per batch instead of once per tweet amortizes the cost of flushing the WAL to disk.
+    If the batch fails because of bad data, the transaction is rolled back and the tweets are retried one per transaction,
+    so that a single bad tweet does not prevent the rest of the batch from being loaded.
+    Any other error (e.g. a lost connection) stops the load.
+
+    Args:
+        connection: a sqlalchemy connection to the postgresql db
+        tweets: a list of dictionaries representing the json tweet objects
+
+    NOTE:
+    This function cannot be tested with standard python testing tools because it interacts with the db.
+    '''
+    data_errors = (psycopg2.DataError, psycopg2.IntegrityError)
+    try:
+        flush_transaction(connection,tweets)
+    except (psycopg2.Error, sqlalchemy.exc.DBAPIError) as e:
+        if not isinstance(db_error(e), data_errors):
+            raise
+        print(datetime.datetime.now(),'batch failed, retrying tweets individually:',db_error(e))
+
+        for tweet in tweets:
+            try:
+                flush_transaction(connection,[tweet])
+            except (psycopg2.Error, sqlalchemy.exc.DBAPIError) as e:
+                if not isinstance(db_error(e), data_errors):
+                    raise
+                print(datetime.datetime.now(),'skipping tweet','id=',tweet.get('id'),db_error(e))
 
 
 def insert_tweet(connection,tweet):
     '''
-    Insert the tweet into the database.
+    Insert a single tweet into the database.
+    Like flush_batch, this function does not open a transaction itself.
 
     Args:
         connection: a sqlalchemy connection to the postgresql db
@@ -83,90 +444,71 @@ def insert_tweet(connection,tweet):
 
     NOTE:
     This function cannot be tested with standard python testing tools because it interacts with the db.
-    
-    FIXME:
-    This function is only partially implemented.
-    You'll need to add appropriate SQL insert statements to get it to work.
     '''
+    flush_batch(connection,[tweet])
 
-    # insert tweet within a transaction;
-    # this ensures that a tweet does not get "partially" loaded
-    with connection.begin() as trans:
-        # skip tweet if it's already inserted
-        sql=sqlalchemy.sql.text('''
-         SELECT id_tweets 
-         FROM tweets
-         WHERE id_tweets = :id_tweets
-        ''')
-        res = connection.execute(sql,{'id_tweets':tweet['id'],})  
 
-        if res.first() is not None:
-            return
-        ########################################
-        # insert into the users table
-        ########################################
-        if tweet['user']['url'] is None:
-            user_id_urls = None
-        else:
-            user_id_urls = get_id_urls(tweet['user']['url'], connection)
-        
-        # create/update the user
-        # check if the user already exist
-        user = tweet.get('user',{})
+def flush_batch(connection,tweets):
+    '''
+    Insert a batch of tweets into the database.
 
-        sql_check_user_id=sqlalchemy.sql.text('''
-         SELECT id_users
-         FROM users
-         WHERE id_users = :id_users
-         ''')
-        res = connection.execute(sql_check_user_id,{
-            'id_users':user['id'],
-        })
+    Inserting tweets one row at a time requires one round-trip to the db for every row of every table,
+    and the loader spends almost all of its time waiting on the network.
+    Instead, we first collect the rows for each table into python lists,
+    and then load each table with a single COPY (see flush_tables).
+    The tables are inserted in foreign key order:
+    urls -> users (hydrated and unhydrated) -> tweets -> tweet_urls/tweet_mentions/tweet_tags/tweet_media.
 
-        sql_insert = sqlalchemy.sql.text('''
-        insert into users
-            (id_users, created_at, updated_at, id_urls, friends_count,
-            listed_count, favourites_count, statuses_count, protected, verified,
-            screen_name, name, location, description, withheld_in_countries)
-            values
-            (:id_users, :created_at, :updated_at, :id_urls, :friends_count,
-            :listed_count, :favourites_count, :statuses_count, :protected, :verified,
-            :screen_name, :name,:location, :description, :withheld_in_countries)
-        on conflict do nothing
-        ;
-        ''')
+    Args:
+        connection: a sqlalchemy connection to the postgresql db
+        tweets: a list of dictionaries representing the json tweet objects
 
-        sql_update = sqlalchemy.sql.text('''
-        update users
-        set
-         id_users = :id_users,
-         created_at = :created_at, 
-         updated_at = :updated_at, 
-         id_urls = :id_urls, 
-         friends_count = :friends_count,
-         listed_count = :listed_count,
-         favourites_count = :favourites_count,
-         statuses_count = :statuses_count,
-         protected = :protected,
-         verified = :verified,
-         screen_name = :screen_name,
-         name = :name,
-         location = :location,
-         description = :description,
-         withheld_in_countries = :withheld_in_countries
-        where id_users = :id_users
-        ;
-        ''')
-        
-        if res.first() is not None:
-            sql = sql_update
-        else:
-            sql = sql_insert
-        data = {
-                'id_users':user.get('id', None),
+    NOTE:
+    This function does not open a transaction itself;
+    the caller is responsible for committing (or rolling back) the inserted rows.
+
+    NOTE:
+    This function cannot be tested with standard python testing tools because it interacts with the db.
+    '''
+    cursor = connection.connection.cursor()
+
+    # tweets that are already in the db are skipped by the "on conflict do nothing" of each insert;
+    # a tweet repeated within the batch is only collected once
+    batch_ids = set()
+
+    # hydrated users are stored in a dict so that a user appearing in several tweets
+    # of the batch is only upserted once (postgres rejects an upsert that touches the same row twice);
+    # later tweets overwrite earlier ones, just like the "do update" below would
+    users_rows = {}
+    unhydrated_users_rows = {}
+    tweets_rows = []
+    tweet_urls_rows = []
+    tweet_mentions_rows = []
+    tweet_tags_rows = []
+    tweet_media_rows = []
+
+    for tweet in tweets:
+        tweet_id = tweet['id']
+        if tweet_id in batch_ids:
+            continue
+        batch_ids.add(tweet_id)
+
+        # these fields are used several times below, so they are only looked up once
+        reply_uid = tweet.get('in_reply_to_user_id')
+        withheld_in_countries = tweet.get('withheld_in_countries')
+        place = tweet.get('place')
+        user = tweet.get('user',{})
+        uid = user.get('id')
+
+        ########################################
+        # users table
+        ########################################
+        # the url is replaced by its id_urls once all of the batch's urls have been resolved
+        users_rows[uid] = {
+                'id_users':uid,
                 'created_at':user.get('created_at', None),
                 'updated_at':user.get('updated_at',None),
-                'id_urls':user_id_urls,
+                'id_urls':user['url'],
                 'friends_count':user.get('friends_count', 0),
                 'listed_count':user.get('listed_count',0),
                 'favourites_count':user.get('favourites_count',0),
@@ -177,200 +519,102 @@ def insert_tweet(connection,tweet):
                 'name':remove_nulls(user.get('name',None)),
                 'location':remove_nulls(user.get('location',None)),
                 'description':remove_nulls(user.get('description',None)),
-                'withheld_in_countries':remove_nulls(tweet.get('withheld_in_countries',None))
+                'withheld_in_countries':remove_nulls(withheld_in_countries)
          }
-        res= connection.execute(sql, data)
 
         ########################################
-        # insert into the tweets table
+        # tweets table
         ########################################
-        
-        geo =''
-        try:
-            geo_coords = tweet['geo']['coordinates']
-            geo_coords = str(tweet['geo']['coordinates'][0]) + ' ' + str(tweet['geo']['coordinates'][1])
-            geo_str = 'POINT'
-            geo = geo_str+'('+geo_coords+')'
-        except TypeError:
-            try:
-                geo_coords = '('
-                for i,poly in enumerate(tweet['place']['bounding_box']['coordinates']):
-                    if i>0:
-                        geo_coords+=','
-                    geo_coords+='('
-                    for j,point in enumerate(poly):
-                        geo_coords+= str(point[0]) + ' ' + str(point[1]) + ','
-                    geo_coords+= str(poly[0][0]) + ' ' + str(poly[0][1])
-                    geo_coords+=')'
-                geo_coords+=')'
-                geo_str = 'MULTIPOLYGON'
-                geo  = 'POLYGON' + geo_coords
-            except KeyError:
-                if tweet['user']['geo_enabled']:
-                    geo_str = None
-                    geo_coords = None
-                    geo = geo_str
+
+        geo = build_geo(tweet)
 
         try:
             text = tweet['extended_tweet']['full_text']
         except:
             text = tweet['text']
 
-        try:
-            country_code = tweet['place']['country_code'].lower()
-        except TypeError:
+        if place is None:
             country_code = None
+            place_name = None
+        else:
+            country_code = place['country_code'].lower()
+            place_name = place['full_name']
 
         if country_code == 'us':
-            state_code = tweet['place']['full_name'].split(',')[-1].strip().lower()
-            if len(state_code)>2:
+            state_code = place_name.split(',')[-1].strip().lower()
+            if state_code not in _us_state_codes:
                 state_code = None
         else:
             state_code = None
 
-        try:
-            place_name = tweet['place']['full_name']
-        except TypeError:
-            place_name = None
-
         # NOTE:
         # The tweets table has the following foreign key:
         # > FOREIGN KEY (in_reply_to_user_id) REFERENCES users(id_users)
         #
         # This means that every "in_reply_to_user_id" field must reference a valid entry in the users table.
-        # If the id is not in the users table, then you'll need to add it in an "unhydrated" form.
-        if tweet.get('in_reply_to_user_id',None) is not None:
-            res_id_in_users = connection.execute(sql_check_user_id,
-                    {'id_users':tweet.get('in_reply_to_user_id'),})
-            
-            if res_id_in_users.first() is  None:
-
-                sql_id_insert=sqlalchemy.sql.text('''
-                insert into users
-                    (id_users)
-                    values
-                    (:id_users)
-                on conflict do nothing
-                ;
-                ''')
-
-                res_insert = connection.execute(sql_id_insert, {'id_users':tweet.get('in_reply_to_user_id'),})
-
-        # insert the tweet
-        sql_in_tweets=sqlalchemy.sql.text(f'''
-           insert into tweets
-           (id_tweets, id_users, created_at, in_reply_to_status_id,
-           in_reply_to_user_id, quoted_status_id,
-           retweet_count, favorite_count,
-           quote_count, withheld_copyright,
-           withheld_in_countries, source, text,
-           country_code, state_code,
-           lang, place_name, geo)
-           values
-          (:id_tweets, :id_users, :created_at, :in_reply_to_status_id,
-           :in_reply_to_user_id, :quoted_status_id,
-           :retweet_count, :favorite_count,
-           :quote_count, :withheld_copyright,
-           :withheld_in_countries, :source, :text,
-           :country_code, :state_code,
-           :lang, :place_name, :geo) 
-           on conflict do nothing
-           ;
-        ''')
-        data = {
-                'id_tweets':tweet.get('id',None),
-                'id_users':user.get('id',None),
-                'created_at':tweet.get('created_at',None),
-                'in_reply_to_status_id': tweet.get('in_reply_to_status_id', None),
-                'in_reply_to_user_id':tweet.get('in_reply_to_user_id',None),
-                'quoted_status_id':tweet.get('quoted_status_id',None),
-                'retweet_count':tweet.get('retweet_count',0),
-                'favorite_count':tweet.get('favorite_count',0),
-                'quote_count':tweet.get('quote_count',0),
-                'withheld_copyright':tweet.get('withheld_copyright',False),
-                'withheld_in_countries':tweet.get('withheld_in_countries',None),
-                'source':remove_nulls(tweet.get('source',None)),
-                'text':remove_nulls(text),
-                'country_code':country_code,
-                'state_code':state_code,
-                'lang':remove_nulls(tweet.get('lang','')),
-                'place_name':place_name,
-                'geo':geo
-            }
-        res_tweets = connection.execute(sql_in_tweets,data)
-         
+        # If the id is not in the users table, then we add it in an "unhydrated" form;
+        # these users are derived from stage_tweets by the users insert (see prepare_statements).
+
+        tweets_rows.append((
+            tweet_id,
+            uid,
+            tweet.get('created_at',None),
+            tweet.get('in_reply_to_status_id', None),
+            reply_uid,
+            tweet.get('quoted_status_id',None),
+            tweet.get('retweet_count',0),
+            tweet.get('favorite_count',0),
+            tweet.get('quote_count',0),
+            tweet.get('withheld_copyright',False),
+            withheld_in_countries,
+            remove_nulls(tweet.get('source',None)),
+            remove_nulls(text),
+            country_code,
+            state_code,
+            remove_nulls(tweet.get('lang','')),
+            place_name,
+            geo,
+            ))
+
         ########################################
-        # insert into the tweet_urls table
+        # tweet_urls table
         ########################################
 
         try:
             urls = tweet['extended_tweet']['entities']['urls']
         except KeyError:
             urls = tweet['entities']['urls']
-        sql_in_tweet_urls=sqlalchemy.sql.text('''
-        insert into tweet_urls
-            (id_tweets, id_urls)
-            values
-            (:id_tweets, :id_urls)
-            on conflict do nothing
-            ;
-        ''')
-        id_tweet = tweet.get('id', None)
         for url in urls:
-            id_urls = get_id_urls(url['expanded_url'], connection)
-            
-           # sql_in_tweet_urls=sqlalchemy.sql.text('''
-            #    ''')
-            res_insert_urls = connection.execute(sql_in_tweet_urls,
-                    {'id_tweets':id_tweet, 'id_urls':id_urls})
+            tweet_urls_rows.append((tweet_id, url['expanded_url']))
+
         ########################################
-        # insert into the tweet_mentions table
+        # tweet_mentions table
         ########################################
 
         try:
             mentions = tweet['extended_tweet']['entities']['user_mentions']
         except KeyError:
             mentions = tweet['entities']['user_mentions']
+
+        # a user can be mentioned several times in the same tweet, but only needs one row
+        mentions = {mention.get('id'): mention for mention in mentions}.values()
         for mention in mentions:
-            # insert into users table;
-            # note that we already have done an insert into the users table above for the user who sent a tweet;
-            # that insert had lots of information inside of it (i.e. the user row was "hydrated");
+            mention_id = mention.get('id')
+            tweet_mentions_rows.append((tweet_id, mention_id))
+
+            # we already have a "hydrated" row for the user who sent the tweet;
             # when we only have a mention of a user, however, we do not have all the information to store in the row;
             # therefore, we must store the user info "unhydrated"
-            # HINT:
-            # use the ON CONFLICT DO NOTHING syntax
-           #TODO: probably check if the user is already in the users table
-           #one problem might be that we don't have access to uncommited changes
-           # to users table above
-            sql_id_users_insert=sqlalchemy.sql.text('''
-                insert into users
-                    (id_users, screen_name, name)
-                    values
-                    (:id_users, :screen_name, :name)
-                on conflict do nothing
-                ;
-                ''')
-
-            res_insert = connection.execute(sql_id_users_insert,
-                    {'id_users':mention.get('id',None),
-                     'screen_name':remove_nulls(mention.get('screen_name',None)),
-                     'name':remove_nulls(mention.get('name',None)),
-                    })
-
-            # insert into tweet_mentions
-            sql_into_tweet_mentions=sqlalchemy.sql.text('''
-              insert into tweet_mentions
-                  (id_tweets, id_users)
-                  values
-                  (:id_tweets, :id_users)
-              on conflict do nothing
-              ;
-            ''')
+            if mention_id in seen_user_ids:
+                continue
+            unhydrated_users_rows.setdefault(mention_id, {
+                'id_users':mention_id,
+                'screen_name':remove_nulls(mention.get('screen_name',None)),
+                'name':remove_nulls(mention.get('name',None)),
+                })
 
-            res_mention_insert = connection.execute(sql_into_tweet_mentions,
-                    {'id_tweets':tweet.get('id',None), 'id_users':mention.get('id',None)})
         ########################################
-        # insert into the tweet_tags table
+        # tweet_tags table
         ########################################
 
         try:
@@ -380,24 +624,14 @@ def insert_tweet(connection,tweet):
             hashtags = tweet['entities']['hashtags']
             cashtags = tweet['entities']['symbols']
 
-        tags = [ '#'+hashtag['text'] for hashtag in hashtags ] + [ '$'+cashtag['text'] for cashtag in cashtags ]
-
-        sql_into_tags=sqlalchemy.sql.text('''
-             insert into tweet_tags
-                (id_tweets, tag)
-                values
-                (:id_tweets, :tag)
-             on conflict do nothing
-             ;
-         ''')
+        # a tag can be used several times in the same tweet, but only needs one row
+        tags = { '#'+hashtag['text'] for hashtag in hashtags } | { '$'+cashtag['text'] for cashtag in cashtags }
 
         for tag in tags: 
-            res_tags_insert = connection.execute(sql_into_tags,
-                    {'id_tweets':tweet.get('id',None), 'tag': remove_nulls(tag)}
-                    )
-        
+            tweet_tags_rows.append((tweet_id, remove_nulls(tag)))
+
         ########################################
-        # insert into the tweet_media table
+        # tweet_media table
         ########################################
 
         try:
@@ -407,28 +641,210 @@ def insert_tweet(connection,tweet):
                 media = tweet['extended_entities']['media']
             except KeyError:
                 media = []
-        
-        sql_into_media = sqlalchemy.sql.text('''
-            insert into tweet_media
-                (id_tweets, id_urls, type)
-                values
-                (:id_tweets, :id_urls, :type)
-            on conflict do nothing
-            ;
-        ''')
 
         for medium in media:
-            id_urls = get_id_urls(medium['media_url'], connection)
-            
-            res_media_insert = connection.execute(sql_into_media,
-                   {'id_tweets':tweet.get('id',None), 'id_urls':id_urls,
-                       'type':medium.get('type',None)}
-                   )
+            tweet_media_rows.append((tweet_id, medium['media_url'], medium.get('type',None)))
+
+    ########################################
+    # flush the urls table
+    ########################################
+
+    # resolve every url of the batch at once, then replace the urls in the rows with their id_urls
+    batch_urls = [ row['id_urls'] for row in users_rows.values() if row['id_urls'] is not None ]
+    batch_urls += [ url for id_tweets,url in tweet_urls_rows ]
+    batch_urls += [ url for id_tweets,url,type in tweet_media_rows ]
+    id_urls = get_id_urls_many(batch_urls, connection)
+
+    for row in users_rows.values():
+        if row['id_urls'] is not None:
+            row['id_urls'] = id_urls[row['id_urls']]
+    tweet_urls_rows = [ (id_tweets, id_urls[url]) for id_tweets,url in tweet_urls_rows ]
+    tweet_media_rows = [ (id_tweets, id_urls[url], type) for id_tweets,url,type in tweet_media_rows ]
+
+    ########################################
+    # flush the users/tweets/tweet_urls/tweet_mentions/tweet_tags/tweet_media tables
+    ########################################
+
+    # the hydrated and unhydrated users are flushed together (see prepare_statements);
+    # a user that is hydrated in this batch does not also need an unhydrated row;
+    # the columns missing from the unhydrated rows are null
+    for id_users,row in unhydrated_users_rows.items():
+        users_rows.setdefault(id_users, row)
+    columns = table_columns['users']
+
+    # the tables are flushed in the order of this dict;
+    # all of the users, including the reply users derived from the staged tweets,
+    # are flushed before the tweets that reference them
+    flush_tables(cursor, {
+        'users': [ tuple(users_rows[id_users].get(column) for column in columns) for id_users in sorted(users_rows) ],
+        'tweets': tweets_rows,
+        'tweet_urls': tweet_urls_rows,
+        'tweet_mentions': tweet_mentions_rows,
+        'tweet_tags': tweet_tags_rows,
+        'tweet_media': tweet_media_rows,
+        })
+    seen_user_ids.update(users_rows)
 
 ################################################################################
 # main functions
 ################################################################################
 
+def drop_foreign_keys(connection):
+    '''
+    Drop the foreign keys of the tables that the loader inserts into,
+    and return the (table, name, definition) of each one so that restore_foreign_keys can recreate them.
+
+    Checking the foreign keys of every inserted row is one of the largest costs of a bulk load;
+    validating them all at once after the load is much faster.
+    The primary keys and unique constraints are kept, because the "on conflict" clauses need them
+    to deduplicate tweets, users, and urls.
+
+    NOTE:
+    The definitions of the dropped foreign keys only exist in memory until restore_foreign_keys runs;
+    so that they are not lost if the loader dies first, the statements that recreate them are printed before they are dropped.
+
+    NOTE:
+    This function cannot be tested with standard python testing tools because it interacts with the db.
+    '''
+    with connection.begin() as trans:
+        cursor = connection.connection.cursor()
+        cursor.execute('''
+        select conrelid::regclass::text, conname, pg_get_constraintdef(oid)
+        from pg_constraint
+        where
+            contype = 'f' and
+            conrelid = any(%s::regclass[])
+        order by 1, 2
+        ;
+        ''', (list(table_columns),))
+        constraints = cursor.fetchall()
+
+        print(datetime.datetime.now(),'dropping foreign keys; if the load fails, recreate them with:')
+        for table,name,definition in constraints:
+            print(f'alter table {table} add constraint "{name}" {definition};')
+
+        for table,name,definition in constraints:
+            cursor.execute(f'alter table {table} drop constraint "{name}";')
+    return constraints
+
+
+def restore_foreign_keys(connection, constraints):
+    '''
+    Recreate the foreign keys dropped by drop_foreign_keys.
+
+    The constraints are first added as "not valid" and committed,
+    which only takes brief locks because postgres does not check the existing rows;
+    each constraint is then validated in its own transaction,
+    which checks all of the existing rows at once without blocking writes to the tables.
+    Validation fails if the load inserted a row that violates a foreign key;
+    the constraint then remains "not valid" (it is still enforced for new rows)
+    until the bad rows are fixed and the constraint is validated by hand.
+
+    NOTE:
+    This function cannot be tested with standard python testing tools because it interacts with the db.
+    '''
+    with connection.begin() as trans:
+        cursor = connection.connection.cursor()
+        for table,name,definition in constraints:
+            cursor.execute(f'alter table {table} add constraint "{name}" {definition} not valid;')
+
+    for table,name,definition in constraints:
+        with connection.begin() as trans:
+            cursor = connection.connection.cursor()
+            cursor.execute(f'alter table {table} validate constraint "{name}";')
+
+
+def read_lines(filename, subfilename):
+    '''
+    Yield the lines of a member of a zip file as bytes;
+    orjson parses bytes directly, so the lines do not need to be decoded first.
+
+    The member is decompressed by a separate `unzip -p` process when one is installed,
+    which leaves this process free to parse the tweets;
+    otherwise, it is read with python's zipfile module.
+    In both cases, the data is read in 1 MiB chunks.
+
+    NOTE:
+    unzip treats its member arguments as wildcard patterns,
+    so the characters []*?\\ in a member name must be escaped to match only that member;
+    a member name starting with '-' would be parsed as an option, so those are read with zipfile.
+    '''
+    if shutil.which('unzip') is None or subfilename.startswith('-'):
+        with zipfile.ZipFile(filename, 'r') as archive:
+            with io.BufferedReader(archive.open(subfilename), buffer_size=1<<20) as f:
+                yield from f
+        return
+
+    pattern = re.sub(r'([\[\]*?\\])', r'\\\1', subfilename)
+    with subprocess.Popen(['unzip', '-p', filename, pattern], stdout=subprocess.PIPE, bufsize=1<<20) as proc:
+        yield from proc.stdout
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+
+def make_engine(db):
+    '''
+    Return an engine for the db with the session settings used for loading.
+    Every connection of the loader is created by this function, so they all share these settings.
+
+    Each worker only ever uses a single connection, so there is no need for a connection pool.
+    The larger maintenance_work_mem speeds up the validation of the restored foreign keys.
+
+    NOTE:
+    with synchronous_commit=off, a commit returns before its WAL is flushed to disk;
+    if the db crashes during the load, the last few batches may be lost and the load must be rerun;
+    this is safe because every insert uses "on conflict", so reloading a file does not duplicate rows.
+    '''
+    return sqlalchemy.create_engine(db, poolclass=sqlalchemy.pool.NullPool, connect_args={
+        'application_name': 'load_tweets.py',
+        'options': '-c synchronous_commit=off -c work_mem=256MB -c maintenance_work_mem=1GB',
+        })
+
+
+def load_file(filename, db, batch_size, print_every):
+    '''
+    Load every tweet in a zip file into the database.
+
+    Each call opens its own connection to the db,
+    so that several files can be loaded in parallel by separate processes.
+
+    NOTE:
+    This function cannot be tested with standard python testing tools because it interacts with the db.
+    '''
+
+    # create database connection
+    engine = make_engine(db)
+    connection = engine.connect()
+
+    prepare_statements(connection)
+
+    with zipfile.ZipFile(filename, 'r') as archive: 
+        subfilenames = sorted(archive.namelist(), reverse=True)
+
+    print(datetime.datetime.now(),filename)
+    for subfilename in subfilenames:
+        batch = []
+        for i,line in enumerate(read_lines(filename, subfilename)):
+
+            # load the tweet and insert it once the batch is full
+            tweet = orjson.loads(line)
+            batch.append(tweet)
+            if len(batch)>=batch_size:
+                insert_batch(connection,batch)
+                batch = []
+
+            # print message
+            if i%print_every==0:
+                print(datetime.datetime.now(),filename,subfilename,'i=',i,'id=',tweet['id'])
+
+        # insert the tweets left over in the final partial batch
+        if batch:
+            insert_batch(connection,batch)
+
+    connection.close()
+    engine.dispose()
+
+
 if __name__ == '__main__':
     
     # process command line args
@@ -437,29 +853,34 @@ if __name__ == '__main__':
     parser.add_argument('--db',required=True)
     parser.add_argument('--inputs',nargs='+',required=True)
     parser.add_argument('--print_every',type=int,default=1000)
+    parser.add_argument('--batch_size',type=int,default=1000)
+    parser.add_argument('--num_workers',type=int,default=os.cpu_count())
+    parser.add_argument('--drop_foreign_keys',action='store_true',
+        help='drop the foreign keys during the load and validate them once afterwards')
     args = parser.parse_args()
 
-    # create database connection
-    engine = sqlalchemy.create_engine(args.db, connect_args={
-        'application_name': 'load_tweets.py',
-        })
-    connection = engine.connect()
-
-    # loop through the input file
+    # loop through the input files;
+    # parsing the tweets is CPU bound, so each file is loaded by a separate worker process
+    # with its own db connection; keep num_workers below the db's max_connections
     # NOTE:
     # we reverse sort the filenames because this results in fewer updates to the users table,
-    # which prevents excessive dead tuples and autovacuums
-    for filename in sorted(args.inputs, reverse=True):
-        with zipfile.ZipFile(filename, 'r') as archive: 
-            print(datetime.datetime.now(),filename)
-            for subfilename in sorted(archive.namelist(), reverse=True):
-                with io.TextIOWrapper(archive.open(subfilename)) as f:
-                    for i,line in enumerate(f):
-
-                        # load and insert the tweet
-                        tweet = json.loads(line)
-                        insert_tweet(connection,tweet)
-
-                        # print message
-                        if i%args.print_every==0:
-                            print(datetime.datetime.now(),filename,subfilename,'i=',i,'id=',tweet['id'])
+    # which prevents excessive dead tuples and autovacuums;
+    # with chunksize=1 the workers still pick up the files in this order
+    filenames = sorted(args.inputs, reverse=True)
+    load = functools.partial(load_file, db=args.db, batch_size=args.batch_size, print_every=args.print_every)
+
+    # NOTE:
+    # the connection is closed while the workers run, so that they do not inherit it when they are forked
+    if args.drop_foreign_keys:
+        engine = make_engine(args.db)
+        with engine.connect() as connection:
+            constraints = drop_foreign_keys(connection)
+
+    try:
+        with multiprocessing.Pool(max(1, min(args.num_workers, len(filenames)))) as pool:
+            pool.map(load, filenames, chunksize=1)
+    finally:
+        if args.drop_foreign_keys:
+            print(datetime.datetime.now(),'restoring foreign keys')
+            with engine.connect() as connection:
+                restore_foreign_keys(connection, constraints)